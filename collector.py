@@ -27,6 +27,13 @@ class Collector(object):
 
         self.cluster = cluster_obj
 
+    def update_config(self, config):
+        # swap in settings from a reloaded config; wait for any in-progress collect() to finish first
+        with self._access_lock:
+            self.exceeded_only = config['exporter']['exceeded_only']
+            self.filesystems = config['cluster']['filesystems']
+        log.info("config reloaded")
+
     def collect(self):
 
         global quota_objs
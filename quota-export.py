@@ -1,95 +1,266 @@
 import argparse
+import functools
+import glob
+import hashlib
+import importlib.util
+import json
 import logging
 import logging.handlers
 import os
 import platform
+import signal
 import socket
+import stat
 import sys
-import time
-import traceback
+import tempfile
+import threading
 
-import prometheus_client
+# NOTE: asyncio, wekalib, prometheus_client, yaml and collector are imported where they're used so that
+# --version/--help (and starts with a cached config) don't pay for importing them
 
-import wekalib
-import yaml
-from wekalib import signal_handling, WekaCluster
+VERSION = "2025-06-25"
 
-from collector import Collector
+# parsed config files are cached here so restarts don't have to re-parse the yaml.  We load whatever
+# we find in here, so it has to be private to us - it's only used if it's ours and mode 0700
+CONFIG_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "quota-export")
 
-VERSION = "2025-06-25"
+# defaults for optional settings in the cluster: and exporter: stanzas
+DEFAULT_CLUSTER = {'force_https': False, 'filesystems': None, 'verify_cert': True, 'mgmt_port': 14000}
+DEFAULT_EXPORTER = {'timeout': 10, 'backends_only': True, 'exceeded_only': True}
 
 # set the root log
 log = logging.getLogger()
 
+# set by SIGTERM/SIGINT to let the main thread exit
+_stop_event = threading.Event()
+
+# yaml parsing function, chosen by _yaml_parser()
+_YAML_PARSER = None
+
+# settings that must be booleans; ryaml follows yaml 1.2, so yes/no/on/off come back as strings
+_BOOLEAN_SETTINGS = {'cluster': ('force_https', 'verify_cert'), 'exporter': ('backends_only', 'exceeded_only')}
+# exactly the spellings PyYAML's yaml 1.1 resolver treats as booleans
+_YAML11_BOOLEANS = {'yes': True, 'Yes': True, 'YES': True, 'true': True, 'True': True, 'TRUE': True,
+                    'on': True, 'On': True, 'ON': True,
+                    'no': False, 'No': False, 'NO': False, 'false': False, 'False': False, 'FALSE': False,
+                    'off': False, 'Off': False, 'OFF': False}
+
+def _config_cache_prefix(inputfile):
+    # key on the config path, our version and the yaml parser, so an exporter upgrade or installing/removing
+    # ryaml invalidates the cache
+    key = f"{os.path.abspath(inputfile)}:{VERSION}:{_yaml_parser_name()}".encode()
+    return os.path.join(CONFIG_CACHE_DIR, f"quota-export.{hashlib.sha1(key).hexdigest()}.")
+
+def _is_private(st):
+    # owned by us, and nobody else can write to it
+    return st.st_uid == os.geteuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _config_cache_dir_ok(create=False):
+    # only the write path creates the dir; on the read path a missing dir is just a cache miss
+    try:
+        if create:
+            os.makedirs(CONFIG_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(CONFIG_CACHE_DIR)
+    except FileNotFoundError:
+        return False
+    except OSError as exc:
+        log.debug(f"Unable to use config cache dir {CONFIG_CACHE_DIR}: {exc}")
+        return False
+    if not stat.S_ISDIR(st.st_mode) or not _is_private(st) or st.st_mode & 0o077:
+        log.warning(f"Not using config cache dir {CONFIG_CACHE_DIR}: it must be a directory owned by us with mode 0700")
+        return False
+    return True
+
+def _read_config_cache(cachefile):
+    if not _config_cache_dir_ok():
+        return None
+    try:
+        fd = os.open(cachefile, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return None
+    except OSError as exc:
+        log.debug(f"Unable to read config cache {cachefile}: {exc}")
+        return None
+    with os.fdopen(fd, "rb") as f:
+        if not _is_private(os.fstat(f.fileno())):
+            log.warning(f"Ignoring config cache {cachefile}: not owned by us or writable by others")
+            return None
+        try:
+            return json.loads(f.read())
+        except Exception as exc:
+            log.debug(f"Unable to read config cache {cachefile}: {exc}")
+            return None
+
+def _write_config_cache(prefix, cachefile, config):
+    if not _config_cache_dir_ok(create=True):
+        return
+    try:
+        data = json.dumps(config)
+        # don't cache anything json can't represent faithfully (dates, non-string keys, etc)
+        if json.loads(data) != config:
+            raise ValueError("config does not round-trip through json")
+        fd, tmpname = tempfile.mkstemp(dir=CONFIG_CACHE_DIR, prefix=os.path.basename(prefix), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmpname, cachefile)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+    except Exception as exc:
+        log.debug(f"Unable to write config cache {cachefile}: {exc}")
+        return
+
+    # remove caches left behind by older versions of the config file
+    for stale in glob.glob(glob.escape(prefix) + "*.json"):
+        if stale != cachefile:
+            try:
+                os.unlink(stale)
+            except OSError:
+                pass
+
+def _yaml_parser_name():
+    # checked without importing anything, so a config cache hit still doesn't load a yaml parser
+    return "ryaml" if importlib.util.find_spec("ryaml") is not None else "pyyaml"
+
+def _yaml_parser():
+    # pick the parser once, on first use, so reloads don't repeat the imports
+    global _YAML_PARSER
+    if _YAML_PARSER is not None:
+        return _YAML_PARSER
+
+    # use the Rust-backed ryaml parser if it's installed (optional)
+    if _yaml_parser_name() == "ryaml":
+        import ryaml
+        _YAML_PARSER = ryaml.loads
+        return _YAML_PARSER
+
+    # otherwise use the libyaml C loader if PyYAML was built with it
+    import yaml
+    try:
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+    _YAML_PARSER = functools.partial(yaml.load, Loader=Loader)
+    return _YAML_PARSER
+
+def _parse_yaml(data):
+    config = _yaml_parser()(data)
+
+    # ryaml follows yaml 1.2; make yaml 1.1 booleans (what PyYAML gives us) mean the same thing under it
+    if _yaml_parser_name() == "ryaml" and isinstance(config, dict):
+        for stanza, settings in _BOOLEAN_SETTINGS.items():
+            section = config.get(stanza)
+            if not isinstance(section, dict):
+                continue
+            for setting in settings:
+                value = section.get(setting)
+                if isinstance(value, str) and value in _YAML11_BOOLEANS:
+                    section[setting] = _YAML11_BOOLEANS[value]
+    return config
+
 def _load_config(inputfile):
     try:
         f = open(inputfile)
     except Exception as exc:
         raise
     with f:
+        prefix = _config_cache_prefix(inputfile)
+        # size too, since cp -p/touch -r can give a changed file its old mtime
+        st = os.fstat(f.fileno())
+        cachefile = f"{prefix}{st.st_mtime_ns}.{st.st_size}.json"
+        config = _read_config_cache(cachefile)
+        if config is not None:
+            log.debug(f"config loaded from cache {cachefile}")
+            return config
         try:
-            return yaml.load(f, Loader=yaml.FullLoader)
-        except AttributeError:
-            return yaml.load(f)
+            # config files are small; read it in one go rather than letting the parser pull it in chunks
+            config = _parse_yaml(f.read())
         except Exception as exc:
             log.error(f"Error reading config file: {exc}")
             raise
+    _write_config_cache(prefix, cachefile, config)
+    return config
+
+def _apply_defaults(config):
+    # allow defaults for these; values from the config file win
+    config['cluster'] = {**DEFAULT_CLUSTER, **config['cluster']}
+    config['exporter'] = {**DEFAULT_EXPORTER, **config['exporter']}
+    return config
+
+def _stop_handler(signum, frame):
+    log.info(f"{signal.Signals(signum).name} received, exiting")
+    _stop_event.set()
+
+def _reload_handler(configfile, collector, signum, frame):
+    # only the collector settings (filesystems, exceeded_only) can change on the fly; the cluster connection
+    # settings (hosts, auth_token_file, force_https, verify_cert, mgmt_port, timeout, backends_only) and
+    # listen_port need a restart
+    log.info(f"SIGHUP received, reloading config file '{configfile}'")
+    try:
+        config = _load_config(configfile)
+        # an empty file or an empty stanza parses as None, eg: mid-save by an editor that truncates first
+        if not isinstance(config, dict) or not isinstance(config.get('cluster'), dict) \
+                or not isinstance(config.get('exporter'), dict):
+            log.error(f"'cluster:' or 'exporter:' stanza missing or empty in '{configfile}'; keeping current config")
+            return
+        collector.update_config(_apply_defaults(config))
+    except Exception as exc:
+        log.error(f"Error reloading config file '{configfile}': {exc}; keeping current config")
+        return
 
-def prom_client(config):
+def prom_client(config, configfile=None):
+    import asyncio
+    import prometheus_client
+    import wekalib
+    from wekalib import WekaCluster
 
-    error = False
-    for host in config['cluster']['hosts']:
-        try:
-            socket.gethostbyname(host)
-        except socket.gaierror:
-            log.critical(f"Hostname {host} not resolvable - is it in /etc/hosts or DNS?")
-            error = True
-        except Exception as exc:
-            log.critical(exc)
-            error = True
+    from collector import Collector
 
-    if error:
-        log.critical("Errors resolving hostnames given.  Please ensure they are in /etc/hosts or DNS and are resolvable")
-        sys.exit(1)
-    elif 'cluster' not in config:
+    if 'cluster' not in config:
         log.error(f"'cluster:' stanza missing from .yml file - version mismatch between .yml and exporter version?")
         sys.exit(1)
     elif 'exporter' not in config:
         log.error(f"'exporter:' stanza missing from .yml file - version mismatch between .yml and exporter version?")
         sys.exit(1)
 
-    # cluster stanza
-    if 'force_https' not in config['cluster']:  # allow defaults for these
-        config['cluster']['force_https'] = False
+    _apply_defaults(config)
+    cluster_cfg = config['cluster']
+    exporter_cfg = config['exporter']
 
-    if 'filesystems' not in config['cluster']:
-        config['cluster']['filesystems'] = None
+    # resolve all the hosts concurrently so slow DNS doesn't cost us a timeout per host
+    async def resolve_all(hosts):
+        # returns the getaddrinfo() result or the exception raised for each host, in order
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.getaddrinfo(host, None, family=socket.AF_INET, proto=socket.IPPROTO_TCP)
+                                      for host in hosts), return_exceptions=True)
 
-    if 'verify_cert' not in config['cluster']:
-        config['cluster']['verify_cert'] = True
-
-    if 'mgmt_port' not in config['cluster']:
-        config['cluster']['mgmt_port'] = 14000
-
-    # exporter stanza
-    if 'timeout' not in config['exporter']:
-        config['exporter']['timeout'] = 10
-
-    if 'backends_only' not in config['exporter']:
-        config['exporter']['backends_only'] = True
+    error = False
+    hosts = cluster_cfg['hosts']
+    for host, result in zip(hosts, asyncio.run(resolve_all(hosts))):
+        if isinstance(result, (socket.gaierror, socket.herror)):
+            log.critical(f"Hostname {host} not resolvable - is it in /etc/hosts or DNS? ({result})")
+            error = True
+        elif isinstance(result, (ValueError, TypeError)):
+            # config typos: UnicodeError from idna encoding (eg: a label > 63 chars), or a host that isn't a string
+            log.critical(f"Hostname {host} is not a valid hostname - please check the config file ({result})")
+            error = True
+        elif isinstance(result, BaseException):
+            raise result    # anything else is a bug, not a DNS problem
 
-    if 'exceeded_only' not in config['exporter']:
-        config['exporter']['exceeded_only'] = True
+    if error:
+        log.critical("Errors resolving hostnames given.  Please ensure they are in /etc/hosts or DNS and are resolvable")
+        sys.exit(1)
 
-    log.info(f"Timeout set to {config['exporter']['timeout']} secs")
+    log.info(f"Timeout set to {exporter_cfg['timeout']} secs")
 
     try:
-        cluster_obj = WekaCluster(config['cluster']['hosts'], config['cluster']['auth_token_file'],
-                                  force_https=config['cluster']['force_https'],
-                                  verify_cert=config['cluster']['verify_cert'],
-                                  backends_only=config['exporter']['backends_only'],
-                                  timeout=config['exporter']['timeout'],
-                                  mgmt_port=config['cluster']['mgmt_port'])
+        cluster_obj = WekaCluster(cluster_cfg['hosts'], cluster_cfg['auth_token_file'],
+                                  force_https=cluster_cfg['force_https'],
+                                  verify_cert=cluster_cfg['verify_cert'],
+                                  backends_only=exporter_cfg['backends_only'],
+                                  timeout=exporter_cfg['timeout'],
+                                  mgmt_port=cluster_cfg['mgmt_port'])
     except wekalib.exceptions.HTTPError as exc:
         if exc.code == 403:
             log.critical(f"Cluster returned permission error - is the userid level ReadOnly or above?")
@@ -102,55 +273,55 @@ def prom_client(config):
         log.critical(f"Error is {exc}")
         return
     except Exception as exc:
-        log.critical(f"Unable to create Weka Cluster: {exc}")
-        log.critical(traceback.format_exc())
+        log.critical(f"Unable to create Weka Cluster: {exc}", exc_info=True)
         return
 
     # create the WekaCollector object
     collector = Collector(config, cluster_obj)
 
+    # drop prometheus_client's default process/platform/gc collectors - we only export quota metrics,
+    # and they cost a /proc read and gc walk on every scrape
+    for default_collector in (prometheus_client.PROCESS_COLLECTOR, prometheus_client.PLATFORM_COLLECTOR,
+                              prometheus_client.GC_COLLECTOR):
+        prometheus_client.REGISTRY.unregister(default_collector)
+
     #
     # Start up the server to expose the metrics.
     #
-    log.info(f"starting http server on port {config['exporter']['listen_port']}")
+    log.info(f"starting http server on port {exporter_cfg['listen_port']}")
     try:
-        prometheus_client.start_http_server(int(config['exporter']['listen_port']))
+        prometheus_client.start_http_server(int(exporter_cfg['listen_port']))
     except Exception as exc:
-        log.critical(f"Unable to start http server on port {config['exporter']['listen_port']}: {exc}")
+        log.critical(f"Unable to start http server on port {exporter_cfg['listen_port']}: {exc}")
         return 1
 
     # register our custom collector
     prometheus_client.REGISTRY.register(collector)
 
-    while True:
-        time.sleep(30)  # let prometheus_client call-back do it's thing
+    # block until we're told to stop; prometheus_client call-backs do their thing in the http server threads
+    signal.signal(signal.SIGTERM, _stop_handler)
+    signal.signal(signal.SIGINT, _stop_handler)
+    if configfile is not None:
+        signal.signal(signal.SIGHUP, functools.partial(_reload_handler, configfile, collector))
+    _stop_event.wait()
+    log.info("shutting down")
+
 
+_SYSLOG_FORMAT = "%(process)s:%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
+_DEBUG_CONSOLE_FORMAT = "%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
+_VERBOSITY_LEVELS = {
+    0: (logging.INFO, "%(message)s", logging.ERROR),
+    1: (logging.INFO, "%(levelname)s:%(message)s", logging.INFO),
+    2: (logging.DEBUG, _DEBUG_CONSOLE_FORMAT, logging.ERROR),
+    3: (logging.DEBUG, _DEBUG_CONSOLE_FORMAT, logging.DEBUG),
+}
 
 def configure_logging(logger, verbosity, disable_syslog=False):
-    loglevel = logging.INFO     # default logging level
-    libloglevel = logging.ERROR
-
-    # default message formats
-    console_format = "%(message)s"
-    syslog_format =  "%(levelname)s:%(message)s"
-
-    syslog_format =  "%(process)s:%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-
-    if verbosity == 1:
-        loglevel = logging.INFO
-        console_format = "%(levelname)s:%(message)s"
-        syslog_format =  "%(process)s:%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-        libloglevel = logging.INFO
-    elif verbosity == 2:
-        loglevel = logging.DEBUG
-        console_format = "%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-        syslog_format =  "%(process)s:%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-    elif verbosity > 2:
-        loglevel = logging.DEBUG
-        console_format = "%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-        syslog_format =  "%(process)s:%(filename)s:%(lineno)s:%(funcName)s():%(levelname)s:%(message)s"
-        libloglevel = logging.DEBUG
+    # (loglevel, console format, library loglevel) for each verbosity level
+    loglevel, console_format, libloglevel = _VERBOSITY_LEVELS[min(verbosity, len(_VERBOSITY_LEVELS) - 1)]
 
+    # start from a clean slate so calling this again doesn't double-log every record
+    logger.handlers.clear()
 
     # create handler to log to console
     console_handler = logging.StreamHandler()
@@ -159,13 +330,14 @@ def configure_logging(logger, verbosity, disable_syslog=False):
 
     if not disable_syslog:
         # create handler to log to syslog
-        logger.info(f"setting syslog on {platform.platform()}")
-        if platform.platform()[:5] == "macOS":
+        plat = platform.platform()
+        logger.info(f"setting syslog on {plat}")
+        if plat.startswith("macOS"):
             syslogaddr = "/var/run/syslog"
         else:
             syslogaddr = "/dev/log"
         syslog_handler = logging.handlers.SysLogHandler(syslogaddr)
-        syslog_handler.setFormatter(logging.Formatter(syslog_format))
+        syslog_handler.setFormatter(logging.Formatter(_SYSLOG_FORMAT))
 
         # add syslog handler to root logger
         if syslog_handler is not None:
@@ -184,8 +356,6 @@ def configure_logging(logger, verbosity, disable_syslog=False):
     logging.getLogger("collector").setLevel(loglevel)
 
 def main():
-    signal_handling()
-
     parser = argparse.ArgumentParser(description="Prometheus Client for Weka clusters")
     parser.add_argument("-c", "--configfile", dest='configfile', default="./quota-export.yml",
                         help="override ./quota-export.yml as config file")
@@ -200,19 +370,22 @@ def main():
 
     configure_logging(log, args.verbosity, disable_syslog=args.no_syslog)
 
-    if not os.path.exists(args.configfile):
-        log.critical(f"Required configfile '{args.configfile}' does not exist")
-        sys.exit(1)
+    # after logging is configured so anything it logs goes to our handlers
+    from wekalib import signal_handling
+    signal_handling()
 
     log.debug("loading config file")
     try:
         config = _load_config(args.configfile)
+    except FileNotFoundError:
+        log.critical(f"Required configfile '{args.configfile}' does not exist")
+        sys.exit(1)
     except Exception as exc:
         log.critical(f"Error loading config file '{args.configfile}': {exc}")
         return
     log.debug("config file loaded")
 
-    prom_client(config)
+    prom_client(config, args.configfile)
 
 
 # Press the green button in the gutter to run the script.